@@ -23,12 +23,14 @@
 
 import threading
 import asyncio
+import time
 import itertools
 from collections import defaultdict
-from typing import TYPE_CHECKING, Dict, Optional
+from operator import itemgetter
+from typing import TYPE_CHECKING, Dict, Optional, Set, Tuple
 
 from . import bitcoin
-from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY
+from .bitcoin import COINBASE_MATURITY, TYPE_ADDRESS, TYPE_PUBKEY, TYPE_SCRIPT
 from .util import PrintError, profiler, bfh, TxMinedInfo
 from .transaction import Transaction, TxOutput
 from .synchronizer import Synchronizer
@@ -48,6 +50,19 @@ TX_HEIGHT_LOCAL = -2
 TX_HEIGHT_UNCONF_PARENT = -1
 TX_HEIGHT_UNCONFIRMED = 0
 
+# pick the value out of txi entries (prevout, value) and txo entries (value, is_coinbase);
+# sum(map(...)) with these runs the loop in C
+_txi_value = itemgetter(1)
+_txo_value = itemgetter(0)
+
+# omni class C transactions carry their payload in an OP_RETURN output,
+# prefixed with this marker ('omni'); class A and B ones pay to an exodus address
+OMNI_MARKER = '6f6d6e69'
+# fields an omni tx record needs to move tokens between addresses
+_OMNI_REQUIRED_KEYS = frozenset(('amount', 'sender', 'reference'))
+OMNI_EXODUS_ADDRESSES = ('1EXoDusjGwvnjZUyKkxZ4UHEf77z6A5S4P',  # mainnet
+                         'mpexoDuSkGGqvqrkrjiFng38QPkJQVFyqv')  # testnet, regtest
+
 
 class AddTransactionException(Exception):
     pass
@@ -86,19 +101,41 @@ class AddressSynchronizer(PrintError):
             else:
                 self.omni_daemon = None
             self.omni_tx = dict()
+            self.get_omni_delta = self._get_omni_delta
+        else:
+            # non-omni wallets never move tokens; skip the lookups entirely
+            self.get_omni_delta = self._get_omni_delta_disabled
+        # txid -> raw tx, waiting to be decoded by the omni daemon in one batch
+        self._omni_pending = {}
+        # property_id -> name
+        self._omni_propname_cache = {}
+        # txid -> (sender, reference, amount) parsed from omni_tx, or None if the
+        # tx moves no tokens; dropped when omni_tx of the txid changes
+        self._omni_amount_cache = {}  # type: Dict[str, Optional[Tuple[str, str, Decimal]]]
+        # (address, omni_property) -> (time fetched, balance); dropped when a tx is added or removed
+        self._omni_balance_cache = {}  # type: Dict[Tuple[str, str], Tuple[float, Decimal]]
 
         self.history = storage.get('addr_history',{})
         # Verified transactions.  txid -> TxMinedInfo.  Access with self.lock.
         verified_tx = storage.get('verified_tx3', {})
         self.verified_tx = {}  # type: Dict[str, TxMinedInfo]
+        # same content as verified_tx, in the form it is saved to storage
+        self._verified_tx_serialized = {}  # type: Dict[str, tuple]
+        # height -> set of txids in verified_tx at that height, so that reorgs
+        # only look at the affected heights
+        self._verified_tx_by_height = defaultdict(set)  # type: Dict[int, Set[str]]
         for txid, (height, timestamp, txpos, header_hash) in verified_tx.items():
             self.verified_tx[txid] = TxMinedInfo(height=height,
                                                  conf=None,
                                                  timestamp=timestamp,
                                                  txpos=txpos,
                                                  header_hash=header_hash)
+            self._verified_tx_serialized[txid] = (height, timestamp, txpos, header_hash)
+            self._verified_tx_by_height[height].add(txid)
         # Transactions pending verification.  txid -> tx_height. Access with self.lock.
         self.unverified_tx = defaultdict(int)
+        # copy of unverified_tx handed out by get_unverified_txs; dropped when it changes
+        self._unverified_tx_snapshot = None  # type: Optional[Dict[str, int]]
         # true when synchronized
         self.up_to_date = False
         # thread local storage for caching stuff
@@ -127,15 +164,15 @@ class AddressSynchronizer(PrintError):
         return sorted(self.history.keys())
 
     def get_address_history(self, addr):
-        h = []
-        # we need self.transaction_lock but get_tx_height will take self.lock
-        # so we need to take that too here, to enforce order of locks
-        with self.lock, self.transaction_lock:
-            related_txns = self._history_local.get(addr, set())
-            for tx_hash in related_txns:
-                tx_height = self.get_tx_height(tx_hash).height
-                h.append((tx_hash, tx_height))
-        return h
+        h = self._address_history_cache.get(addr)
+        if h is None:
+            # we need self.transaction_lock but get_tx_height will take self.lock
+            # so we need to take that too here, to enforce order of locks
+            with self.lock, self.transaction_lock:
+                related_txns = self._history_local.get(addr, set())
+                h = tuple((tx_hash, self.get_tx_height(tx_hash).height) for tx_hash in related_txns)
+                self._address_history_cache[addr] = h
+        return list(h)
 
     def get_address_history_len(self, addr: str) -> int:
         """Return number of transactions where address is involved."""
@@ -147,12 +184,7 @@ class AddressSynchronizer(PrintError):
             return addr
         prevout_hash = txi.get('prevout_hash')
         prevout_n = txi.get('prevout_n')
-        dd = self.txo.get(prevout_hash, {})
-        for addr, l in dd.items():
-            for n, v, is_cb in l:
-                if n == prevout_n:
-                    return addr
-        return None
+        return self.outpoint_to_txout.get((prevout_hash, prevout_n), (None,))[0]
 
     def get_txout_address(self, txo: TxOutput):
         if txo.type == TYPE_ADDRESS:
@@ -163,6 +195,11 @@ class AddressSynchronizer(PrintError):
             addr = None
         return addr
 
+    @staticmethod
+    def _parse_outpoint(ser: str) -> Tuple[str, int]:
+        prevout_hash, prevout_n = ser.split(':')
+        return prevout_hash, int(prevout_n)
+
     def load_unverified_transactions(self):
         # review transactions that are in the history
         for addr, hist in self.history.items():
@@ -193,7 +230,12 @@ class AddressSynchronizer(PrintError):
     def add_address(self, address):
         if address not in self.history:
             self.history[address] = []
+            self._transactions_modified = True
             self.set_up_to_date(False)
+        with self.lock, self.transaction_lock:
+            if address not in self._wallet_balance_parts:
+                # the wallet domain changed
+                self._reset_wallet_balance()
         if self.synchronizer:
             self.synchronizer.add(address)
 
@@ -210,7 +252,7 @@ class AddressSynchronizer(PrintError):
                     continue
                 prevout_hash = txin['prevout_hash']
                 prevout_n = txin['prevout_n']
-                spending_tx_hash = self.spent_outpoints[prevout_hash].get(prevout_n)
+                spending_tx_hash = self.spent_outpoints.get((prevout_hash, prevout_n))
                 if spending_tx_hash is None:
                     continue
                 # this outpoint has already been spent, by spending_tx
@@ -224,29 +266,24 @@ class AddressSynchronizer(PrintError):
             return conflicting_txns
 
     def omni_getname(self, property_id):
-        if not hasattr(self, 'omni'):
+        if not self.omni:
             return ''
         if self.omni_host == '' or self.omni_daemon is None:
             return ''
+        name = self._omni_propname_cache.get(property_id)
+        if name is not None:
+            return name
         try:
             prop = self.omni_daemon.getProperty(property_id)
             res = prop['result']
             name = res['name']
         except:
-            name = "token_%d" % property_id
+            return "token_%d" % property_id
+        self._omni_propname_cache[property_id] = name
         return name
 
-    def omni_txdata(self, txid, rawtx):
-
-        if not hasattr(self, 'omni'):
-            return {}
-        if self.omni_host == '' or self.omni_daemon is None:
-            return {}
-        if rawtx is None:
-            return {}
-
+    def _omni_txdata_from_response(self, txid, val):
         try:
-            val = self.omni_daemon.decodeTransaction(rawtx)
             if val['error']:
                 return {}
 
@@ -264,6 +301,57 @@ class AddressSynchronizer(PrintError):
         except:
             return {}
 
+    @staticmethod
+    def tx_may_be_omni(tx: Transaction) -> bool:
+        """Cheap local check whether tx can carry an omni payload at all."""
+        for o in tx.outputs():
+            if o.type == TYPE_SCRIPT:
+                script = o.address
+                # OP_RETURN, then a direct push or OP_PUSHDATA1
+                if script[:2] == '6a' and (script[4:12] == OMNI_MARKER
+                                           or script[2:4] == '4c' and script[6:14] == OMNI_MARKER):
+                    return True
+            elif o.address in OMNI_EXODUS_ADDRESSES:
+                return True
+        return False
+
+    def omni_txdata_many(self, txs):
+        """Decode (txid, rawtx) pairs with a single batched RPC call.
+        Returns a dict txid -> omni tx data.
+        """
+        txs = list(txs)
+        out = {txid: {} for txid, rawtx in txs}
+        if not self.omni:
+            return out
+        if self.omni_host == '' or self.omni_daemon is None:
+            return out
+        txs = [(txid, rawtx) for txid, rawtx in txs if rawtx is not None]
+        try:
+            responses = self.omni_daemon.decodeTransactions([rawtx for txid, rawtx in txs])
+        except:
+            return out
+        for (txid, rawtx), val in zip(txs, responses):
+            out[txid] = self._omni_txdata_from_response(txid, val)
+        return out
+
+    def omni_txdata(self, txid, rawtx):
+        return self.omni_txdata_many([(txid, rawtx)])[txid]
+
+    def _flush_omni_pending(self):
+        with self.transaction_lock:
+            if not self._omni_pending:
+                return
+            pending, self._omni_pending = self._omni_pending, {}
+        # talk to the omni daemon without holding the lock
+        txdata = self.omni_txdata_many(pending.items())
+        with self.transaction_lock:
+            for txid, data in txdata.items():
+                # skip txs removed while the daemon was busy
+                if txid in self.transactions:
+                    self.omni_tx[txid] = data
+                    self._omni_amount_cache.pop(txid, None)
+                    self._transactions_modified = True
+
     def add_transaction(self, tx_hash, tx, allow_unrelated=False):
         assert tx_hash, tx_hash
         assert tx, tx
@@ -282,8 +370,8 @@ class AddressSynchronizer(PrintError):
                 # note that during sync, if the transactions are not properly sorted,
                 # it could happen that we think tx is unrelated but actually one of the inputs is is_mine.
                 # this is the main motivation for allow_unrelated
-                is_mine = any([self.is_mine(self.get_txin_address(txin)) for txin in tx.inputs()])
-                is_for_me = any([self.is_mine(self.get_txout_address(txo)) for txo in tx.outputs()])
+                is_mine = any(self.is_mine(self.get_txin_address(txin)) for txin in tx.inputs())
+                is_for_me = any(self.is_mine(self.get_txout_address(txo)) for txo in tx.outputs())
                 if not is_mine and not is_for_me:
                     raise UnrelatedTransactionException()
             # Find all conflicting transactions.
@@ -295,12 +383,11 @@ class AddressSynchronizer(PrintError):
             #     or drop this txn
             conflicting_txns = self.get_conflicting_transactions(tx_hash, tx)
             if conflicting_txns:
+                conflicting_heights = [self.get_tx_height(tx_hash2).height for tx_hash2 in conflicting_txns]
                 existing_mempool_txn = any(
-                    self.get_tx_height(tx_hash2).height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT)
-                    for tx_hash2 in conflicting_txns)
-                existing_confirmed_txn = any(
-                    self.get_tx_height(tx_hash2).height > 0
-                    for tx_hash2 in conflicting_txns)
+                    height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT)
+                    for height in conflicting_heights)
+                existing_confirmed_txn = any(height > 0 for height in conflicting_heights)
                 if existing_confirmed_txn and tx_height <= 0:
                     # this is a non-confirmed tx that conflicts with confirmed txns; drop.
                     return False
@@ -315,55 +402,59 @@ class AddressSynchronizer(PrintError):
                 for tx_hash2 in to_remove:
                     self.remove_transaction(tx_hash2)
             # add inputs
-            def add_value_from_prev_output():
-                dd = self.txo.get(prevout_hash, {})
-                # note: this nested loop takes linear time in num is_mine outputs of prev_tx
-                for addr, outputs in dd.items():
-                    # note: instead of [(n, v, is_cb), ...]; we could store: {n -> (v, is_cb)}
-                    for n, v, is_cb in outputs:
-                        if n == prevout_n:
-                            if addr and self.is_mine(addr):
-                                if d.get(addr) is None:
-                                    d[addr] = set()
-                                d[addr].add((ser, v))
-                            return
+            outpoint_to_txout = self.outpoint_to_txout
+            spent_outpoints = self.spent_outpoints
+            spent_outputs = self._spent_outputs
+            self._touch_addrs(itertools.chain(self.txi.get(tx_hash, ()), self.txo.get(tx_hash, ())))
+            self._tx_value_cache.pop(tx_hash, None)
             self.txi[tx_hash] = d = {}
             for txi in tx.inputs():
                 if txi['type'] == 'coinbase':
                     continue
                 prevout_hash = txi['prevout_hash']
                 prevout_n = txi['prevout_n']
-                ser = prevout_hash + ':%d' % prevout_n
-                self.spent_outpoints[prevout_hash][prevout_n] = tx_hash
-                add_value_from_prev_output()
+                spent_outpoints[(prevout_hash, prevout_n)] = tx_hash
+                spent_outputs[prevout_hash].add(prevout_n)
+                # add value from prev output, if it is mine
+                prev_txout = outpoint_to_txout.get((prevout_hash, prevout_n))
+                if prev_txout is None:
+                    continue
+                addr, v, is_cb = prev_txout
+                if addr and self.is_mine(addr):
+                    d.setdefault(addr, set()).add(((prevout_hash, prevout_n), v))
             # add outputs
             self.txo[tx_hash] = d = {}
             for n, txo in enumerate(tx.outputs()):
-                v = txo[2]
-                ser = tx_hash + ':%d'%n
                 addr = self.get_txout_address(txo)
                 if addr and self.is_mine(addr):
-                    if d.get(addr) is None:
-                        d[addr] = []
-                    d[addr].append((n, v, is_coinbase))
+                    v = txo[2]
+                    d.setdefault(addr, {})[n] = (v, is_coinbase)
+                    outpoint_to_txout[(tx_hash, n)] = (addr, v, is_coinbase)
                     # give v to txi that spends me
-                    next_tx = self.spent_outpoints[tx_hash].get(n)
+                    next_tx = spent_outpoints.get((tx_hash, n))
                     if next_tx is not None:
                         dd = self.txi.get(next_tx, {})
-                        if dd.get(addr) is None:
-                            dd[addr] = set()
-                        if (ser, v) not in dd[addr]:
-                            dd[addr].add((ser, v))
+                        dd.setdefault(addr, set()).add(((tx_hash, n), v))
+                        self._tx_value_cache.pop(next_tx, None)
                         self._add_tx_to_local_history(next_tx)
-            if hasattr(self, 'omni'):
+            if self.omni:
                 # add omni tx data
                 if self.omni_host != '':
-                    self.omni_tx[tx_hash] = self.omni_txdata(tx_hash, tx.raw)
+                    if self.tx_may_be_omni(tx):
+                        # decoded later in a single batch, see _flush_omni_pending
+                        self._omni_pending[tx_hash] = tx.raw
+                    else:
+                        self.omni_tx[tx_hash] = {}
+                    self._omni_amount_cache.pop(tx_hash, None)
 
+            # outputs given to txi that spend them belong to these addresses too
+            self._touch_addrs(itertools.chain(self.txi[tx_hash], self.txo[tx_hash]))
             # add to local history
             self._add_tx_to_local_history(tx_hash)
             # save
             self.transactions[tx_hash] = tx
+            self._transactions_modified = True
+            self._omni_balance_cache.clear()
             return True
 
     def remove_transaction(self, tx_hash):
@@ -375,41 +466,58 @@ class AddressSynchronizer(PrintError):
                         continue
                     prevout_hash = txin['prevout_hash']
                     prevout_n = txin['prevout_n']
-                    self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                    if not self.spent_outpoints[prevout_hash]:
-                        self.spent_outpoints.pop(prevout_hash)
+                    self._pop_spent_outpoint((prevout_hash, prevout_n))
             else:  # expensive but always works
-                for prevout_hash, d in list(self.spent_outpoints.items()):
-                    for prevout_n, spending_txid in d.items():
-                        if spending_txid == tx_hash:
-                            self.spent_outpoints[prevout_hash].pop(prevout_n, None)
-                            if not self.spent_outpoints[prevout_hash]:
-                                self.spent_outpoints.pop(prevout_hash)
-            # Remove this tx itself; if nothing spends from it.
-            # It is not so clear what to do if other txns spend from it, but it will be
+                for prevout, spending_txid in list(self.spent_outpoints.items()):
+                    if spending_txid == tx_hash:
+                        self._pop_spent_outpoint(prevout)
+            # Spends of this tx's own outputs are kept.
+            # It is not so clear what to do if other txns spend from it, but they will be
             # removed when those other txns are removed.
-            if not self.spent_outpoints[tx_hash]:
-                self.spent_outpoints.pop(tx_hash)
 
         with self.transaction_lock:
             self.print_error("removing tx from history", tx_hash)
             tx = self.transactions.pop(tx_hash, None)
             remove_from_spent_outpoints()
             self._remove_tx_from_local_history(tx_hash)
-            self.txi.pop(tx_hash, None)
-            self.txo.pop(tx_hash, None)
+            self._omni_pending.pop(tx_hash, None)
+            self._tx_value_cache.pop(tx_hash, None)
+            # this also covers txi of children spending the removed outputs
+            self._touch_addrs(itertools.chain(self.txi.pop(tx_hash, {}), self.txo.get(tx_hash, {})))
+            for addr, outputs in self.txo.pop(tx_hash, {}).items():
+                for n in outputs:
+                    self.outpoint_to_txout.pop((tx_hash, n), None)
+            self._transactions_modified = True
+            self._omni_balance_cache.clear()
+
+    def _pop_spent_outpoint(self, prevout):
+        # call with self.transaction_lock held
+        if self.spent_outpoints.pop(prevout, None) is None:
+            return
+        prevout_hash, prevout_n = prevout
+        spent = self._spent_outputs[prevout_hash]
+        spent.discard(prevout_n)
+        if not spent:
+            del self._spent_outputs[prevout_hash]
 
     def get_depending_transactions(self, tx_hash):
         """Returns all (grand-)children of tx_hash in this wallet."""
-        children = set()
-        for other_hash in self.spent_outpoints[tx_hash].values():
-            children.add(other_hash)
-            children |= self.get_depending_transactions(other_hash)
-        return children
+        with self.transaction_lock:
+            children = set()
+            todo = [tx_hash]
+            while todo:
+                txid = todo.pop()
+                for n in self._spent_outputs.get(txid, ()):
+                    other_hash = self.spent_outpoints[(txid, n)]
+                    if other_hash not in children:
+                        children.add(other_hash)
+                        todo.append(other_hash)
+            return children
 
     def receive_tx_callback(self, tx_hash, tx, tx_height):
         self.add_unverified_tx(tx_hash, tx_height)
         self.add_transaction(tx_hash, tx, allow_unrelated=True)
+        self._flush_omni_pending()
 
     def receive_history_callback(self, addr, hist, tx_fees):
         with self.lock:
@@ -418,10 +526,12 @@ class AddressSynchronizer(PrintError):
                 if (tx_hash, height) not in hist:
                     # make tx local
                     self.unverified_tx.pop(tx_hash, None)
-                    self.verified_tx.pop(tx_hash, None)
+                    self._pop_verified_tx(tx_hash)
+                    self._tx_height_changed(tx_hash)
                     if self.verifier:
                         self.verifier.remove_spv_proof_for_tx(tx_hash)
             self.history[addr] = hist
+            self._transactions_modified = True
 
         for tx_hash, tx_height in hist:
             # add it in case it was previously unconfirmed
@@ -434,44 +544,82 @@ class AddressSynchronizer(PrintError):
 
         # Store fees
         self.tx_fees.update(tx_fees)
+        self._transactions_modified = True
+        self._flush_omni_pending()
 
     @profiler
     def load_transactions(self):
         # load txi, txo, tx_fees
+        # set whenever data persisted by save_transactions changes.
+        # starts out set, so that the first save stores the normalized data.
+        self._transactions_modified = True
         # bookkeeping data of is_mine inputs of transactions
-        self.txi = self.storage.get('txi', {})  # txid -> address -> (prev_outpoint, value)
-        for txid, d in list(self.txi.items()):
-            for addr, lst in d.items():
-                self.txi[txid][addr] = set([tuple(x) for x in lst])
+        # note: the stored data is read without copying; all containers are rebuilt below
+        # stored prev_outpoint is "prevout_hash:prevout_n", kept in memory as (prevout_hash, prevout_n)
+        txi = self.storage.get_nocopy('txi', {})  # txid -> address -> (prev_outpoint, value)
+        self.txi = {txid: {addr: {(self._parse_outpoint(ser), v) for ser, v in lst}
+                           for addr, lst in d.items()}
+                    for txid, d in txi.items()}
         # bookkeeping data of is_mine outputs of transactions
-        self.txo = self.storage.get('txo', {})  # txid -> address -> (output_index, value, is_coinbase)
-        if hasattr(self, 'omni'):
+        # stored as txid -> address -> list of (output_index, value, is_coinbase),
+        # kept in memory as txid -> address -> output_index -> (value, is_coinbase)
+        txo = self.storage.get_nocopy('txo', {})
+        self.txo = {}
+        # reverse index of is_mine outputs: (txid, output_index) -> (address, value, is_coinbase)
+        self.outpoint_to_txout = {}
+        for txid, d in txo.items():
+            self.txo[txid] = dd = {}
+            for addr, outputs in d.items():
+                dd[addr] = outputs = {n: (v, is_cb) for n, v, is_cb in outputs}
+                for n, (v, is_cb) in outputs.items():
+                    self.outpoint_to_txout[(txid, n)] = (addr, v, is_cb)
+        if self.omni:
             # add omni tx data
             if self.omni_host != '':
                 self.omni_tx = self.storage.get('omni_tx', {})
+        self._omni_amount_cache = {}
         self.tx_fees = self.storage.get('tx_fees', {})
-        tx_list = self.storage.get('transactions', {})
+        tx_list = self.storage.get_nocopy('transactions', {})
         # load transactions
         self.transactions = {}
         for tx_hash, raw in tx_list.items():
-            tx = Transaction(raw)
-            self.transactions[tx_hash] = tx
             if self.txi.get(tx_hash) is None and self.txo.get(tx_hash) is None:
                 self.print_error("removing unreferenced tx", tx_hash)
-                self.transactions.pop(tx_hash)
+                continue
+            # note: this does not parse raw yet; that happens lazily, on first use
+            self.transactions[tx_hash] = Transaction(raw)
         # load spent_outpoints
-        _spent_outpoints = self.storage.get('spent_outpoints', {})
-        self.spent_outpoints = defaultdict(dict)
-        for prevout_hash, d in _spent_outpoints.items():
-            for prevout_n_str, spending_txid in d.items():
-                prevout_n = int(prevout_n_str)
-                if spending_txid not in self.transactions:
-                    continue  # only care about txns we have
-                self.spent_outpoints[prevout_hash][prevout_n] = spending_txid
+        # stored as prevout_hash -> prevout_n -> spending txid,
+        # kept in memory as a single dict (prevout_hash, prevout_n) -> spending txid
+        _spent_outpoints = self.storage.get_nocopy('spent_outpoints', {})
+        transactions = self.transactions
+        self.spent_outpoints = {
+            (prevout_hash, int(prevout_n_str)): spending_txid
+            for prevout_hash, d in _spent_outpoints.items()
+            for prevout_n_str, spending_txid in d.items()
+            # only care about txns we have
+            if spending_txid in transactions}
+        # prevout_hash -> set of prevout_n in spent_outpoints, so that children
+        # can be found without having the parent tx
+        self._spent_outputs = defaultdict(set)
+        for prevout_hash, prevout_n in self.spent_outpoints:
+            self._spent_outputs[prevout_hash].add(prevout_n)
 
     @profiler
     def load_local_history(self):
         self._history_local = {}  # address -> set(txid)
+        # address -> tuple of (txid, height); dropped when either side changes
+        self._address_history_cache = {}
+        # address -> (local_height, (c, u, x)) and address -> total received;
+        # dropped when txi/txo or a tx height of the address change, see _touch_addrs
+        self._addr_balance_cache = {}
+        self._addr_received_cache = {}
+        # address -> is_empty; the total balance does not depend on tx heights,
+        # so this is only dropped when txi/txo of the address change
+        self._addr_empty_cache = {}  # type: Dict[str, bool]
+        # txid -> get_tx_value; dropped when txi/txo of the txid change
+        self._tx_value_cache = {}  # type: Dict[str, int]
+        self._reset_wallet_balance()
         self._address_history_changed_events = defaultdict(asyncio.Event)  # address -> Event
         for txid in itertools.chain(self.txi, self.txo):
             self._add_tx_to_local_history(txid)
@@ -479,23 +627,35 @@ class AddressSynchronizer(PrintError):
     @profiler
     def check_history(self):
         save = False
-        hist_addrs_mine = list(filter(lambda k: self.is_mine(k), self.history.keys()))
-        hist_addrs_not_mine = list(filter(lambda k: not self.is_mine(k), self.history.keys()))
-        for addr in hist_addrs_not_mine:
-            self.history.pop(addr)
-            save = True
-        for addr in hist_addrs_mine:
-            hist = self.history[addr]
+        # txids already accounted for in txi/txo
+        known = self._get_txids_with_io()
+        for addr, hist in list(self.history.items()):
+            if not self.is_mine(addr):
+                self.history.pop(addr)
+                self._transactions_modified = True
+                save = True
+                continue
             for tx_hash, tx_height in hist:
-                if self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                if tx_hash in known:
                     continue
                 tx = self.transactions.get(tx_hash)
                 if tx is not None:
+                    num_txs = len(self.transactions)
                     self.add_transaction(tx_hash, tx, allow_unrelated=True)
                     save = True
+                    if self.txi.get(tx_hash) or self.txo.get(tx_hash):
+                        known.add(tx_hash)
+                    if len(self.transactions) < num_txs:
+                        # rare; adding removed conflicting txns, drop them from known
+                        known &= self._get_txids_with_io()
         if save:
             self.save_transactions()
 
+    def _get_txids_with_io(self):
+        with self.transaction_lock:
+            return ({txid for txid, d in self.txi.items() if d}
+                    | {txid for txid, d in self.txo.items() if d})
+
     def remove_local_transactions_we_dont_have(self):
         txid_set = set(self.txi) | set(self.txo)
         for txid in txid_set:
@@ -506,29 +666,41 @@ class AddressSynchronizer(PrintError):
     @profiler
     def save_transactions(self, write=False):
         with self.transaction_lock:
-            tx = {}
-            for k,v in self.transactions.items():
-                tx[k] = str(v)
-            self.storage.put('transactions', tx)
-            self.storage.put('txi', self.txi)
-            self.storage.put('txo', self.txo)
-            if hasattr(self, 'omni'):
-                # add omni tx data
-                if self.omni_host != '':
-                    self.storage.put('omni_tx', self.omni_tx)
-            self.storage.put('tx_fees', self.tx_fees)
-            self.storage.put('addr_history', self.history)
-            self.storage.put('spent_outpoints', self.spent_outpoints)
+            # storage.put serializes, compares and copies its whole value,
+            # so skip all of it if nothing changed since the last save
+            if self._transactions_modified:
+                self._transactions_modified = False
+                # the bulky values are rebuilt here anyway, from immutable leaves,
+                # so they are handed over with put_nocopy instead of being
+                # test-serialized and deep-copied again by put
+                tx = {}
+                for k,v in self.transactions.items():
+                    tx[k] = str(v)
+                self.storage.put_nocopy('transactions', tx)
+                txi = {txid: {addr: [('%s:%d' % prevout, v) for prevout, v in spends]
+                              for addr, spends in d.items()}
+                       for txid, d in self.txi.items()}
+                self.storage.put_nocopy('txi', txi)
+                txo = {txid: {addr: [(n, v, is_cb) for n, (v, is_cb) in outputs.items()]
+                              for addr, outputs in d.items()}
+                       for txid, d in self.txo.items()}
+                self.storage.put_nocopy('txo', txo)
+                if self.omni:
+                    # add omni tx data
+                    if self.omni_host != '':
+                        self.storage.put('omni_tx', self.omni_tx)
+                self.storage.put_nocopy('tx_fees', dict(self.tx_fees))
+                self.storage.put('addr_history', self.history)
+                spent_outpoints = defaultdict(dict)
+                for (prevout_hash, prevout_n), spending_txid in self.spent_outpoints.items():
+                    spent_outpoints[prevout_hash][prevout_n] = spending_txid
+                self.storage.put_nocopy('spent_outpoints', dict(spent_outpoints))
             if write:
                 self.storage.write()
 
     def save_verified_tx(self, write=False):
         with self.lock:
-            verified_tx_to_save = {}
-            for txid, tx_info in self.verified_tx.items():
-                verified_tx_to_save[txid] = (tx_info.height, tx_info.timestamp,
-                                             tx_info.txpos, tx_info.header_hash)
-            self.storage.put('verified_tx3', verified_tx_to_save)
+            self.storage.put('verified_tx3', self._verified_tx_serialized)
             if write:
                 self.storage.write()
 
@@ -537,24 +709,38 @@ class AddressSynchronizer(PrintError):
             with self.transaction_lock:
                 self.txi = {}
                 self.txo = {}
+                self.outpoint_to_txout = {}
                 self.tx_fees = {}
-                self.spent_outpoints = defaultdict(dict)
+                self.spent_outpoints = {}  # (prevout_hash, prevout_n) -> spending txid
+                self._spent_outputs = defaultdict(set)
                 self.history = {}
                 self.verified_tx = {}
+                self._verified_tx_serialized = {}
+                self._verified_tx_by_height = defaultdict(set)
+                self._address_history_cache = {}
+                self._addr_balance_cache = {}
+                self._addr_received_cache = {}
+                self._addr_empty_cache = {}
+                self._tx_value_cache = {}
+                self._reset_wallet_balance()
+                self._omni_pending = {}
+                self._omni_amount_cache = {}
+                self._omni_balance_cache.clear()
+                if self.omni:
+                    self.omni_tx = {}
                 self.transactions = {}  # type: Dict[str, Transaction]
+                self._transactions_modified = True
                 self.save_transactions()
 
     def get_txpos(self, tx_hash):
         """Returns (height, txpos) tuple, even if the tx is unverified."""
-        with self.lock:
-            if tx_hash in self.verified_tx:
-                info = self.verified_tx[tx_hash]
-                return info.height, info.txpos
-            elif tx_hash in self.unverified_tx:
-                height = self.unverified_tx[tx_hash]
-                return (height, 0) if height > 0 else ((1e9 - height), 0)
-            else:
-                return (1e9+1, 0)
+        info, height = self._lookup_tx(tx_hash)
+        if info is not None:
+            return info.height, info.txpos
+        elif height is not None:
+            return (height, 0) if height > 0 else ((1e9 - height), 0)
+        else:
+            return (1e9+1, 0)
 
     def with_local_height_cached(func):
         # get local height only once, as it's relatively expensive.
@@ -568,15 +754,35 @@ class AddressSynchronizer(PrintError):
                 self.threadlocal_cache.local_height = orig_val
         return f
 
+    OMNI_BALANCE_CACHE_TTL = 30  # seconds
+
     def omni_addr_balance(self, domain):
         total = Decimal(0)
+        now = time.monotonic()
+        cache = self._omni_balance_cache
+        # omni_property can be changed in the settings, so it is part of the key
+        property_id = self.omni_property
+        to_fetch = []
         for addr in domain:
+            cached = cache.get((addr, property_id))
+            if cached is not None and now - cached[0] < self.OMNI_BALANCE_CACHE_TTL:
+                total += cached[1]
+            else:
+                to_fetch.append(addr)
+        if not to_fetch:
+            return total
+        try:
+            responses = self.omni_daemon.getBalances(to_fetch, int(property_id))
+        except:
+            return total
+        for addr, val in zip(to_fetch, responses):
             try:
-                val = self.omni_daemon.getBalance(addr, int(self.omni_property))
                 res = val['result']
-                total += Decimal(res['balance'])
+                balance = Decimal(res['balance'])
             except:
-                pass
+                continue
+            cache[(addr, property_id)] = (now, balance)
+            total += balance
         return total
 
     @with_local_height_cached
@@ -587,26 +793,24 @@ class AddressSynchronizer(PrintError):
         domain = set(domain)
         # 1. Get the history of each address in the domain, maintain the
         #    delta of a tx as the sum of its deltas on domain addresses
-        tx_deltas = defaultdict(int)
         omni_deltas = dict()
-        for addr in domain:
-            h = self.get_address_history(addr)
-            for tx_hash, height in h:
-                delta = self.get_tx_delta(tx_hash, addr)
-                if delta is None or tx_deltas[tx_hash] is None:
-                    tx_deltas[tx_hash] = None
-                else:
-                    tx_deltas[tx_hash] += delta
-                omni_delta = self.get_omni_delta(tx_hash, addr)
+        with self.transaction_lock:
+            tx_hashes = set()
+            for addr in domain:
+                tx_hashes.update(self._history_local.get(addr, ()))
+            # one pass per tx over its is_mine addresses, instead of one
+            # get_tx_delta call per (domain address, tx) pair; each tx is
+            # visited once, so there is nothing left to accumulate
+            tx_deltas = {tx_hash: self.get_tx_domain_delta(tx_hash, domain)
+                         for tx_hash in tx_hashes}
+            for tx_hash in tx_hashes:
+                omni_delta = self.get_omni_domain_delta(tx_hash, domain)
                 if omni_delta != 0:
-                    # safety check and append tx_hash to tx_deltas
-                    if not tx_hash in tx_deltas:
-                        tx_deltas[tx_hash] = 0
-                    if tx_hash in omni_deltas:
-                        omni_deltas[tx_hash] += omni_delta
-                    else:
-                        omni_deltas[tx_hash] = omni_delta
+                    omni_deltas[tx_hash] = omni_delta
         # 2. create sorted history
+        with self.lock:
+            tx_mined_infos = {tx_hash: self.get_tx_height(tx_hash) for tx_hash in tx_deltas}
+            txpos = {tx_hash: self.get_txpos(tx_hash) for tx_hash in tx_deltas}
         history = []
         for tx_hash in tx_deltas:
             delta = tx_deltas[tx_hash]
@@ -614,13 +818,13 @@ class AddressSynchronizer(PrintError):
                 omni_delta = omni_deltas[tx_hash]
             else:
                 omni_delta = 0
-            tx_mined_status = self.get_tx_height(tx_hash)
+            tx_mined_status = tx_mined_infos[tx_hash]
             history.append((tx_hash, tx_mined_status, delta, omni_delta))
-        history.sort(key = lambda x: self.get_txpos(x[0]), reverse=True)
+        history.sort(key = lambda x: txpos[x[0]], reverse=True)
         # 3. add balance
         c, u, x = self.get_balance(domain)
         balance = c + u + x
-        if hasattr(self, 'omni') and self.omni:
+        if self.omni:
             omni_balance = self.omni_addr_balance(domain)
         else:
             omni_balance = 0
@@ -647,8 +851,12 @@ class AddressSynchronizer(PrintError):
         with self.transaction_lock:
             for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
                 cur_hist = self._history_local.get(addr, set())
+                if txid in cur_hist:
+                    # add_transaction is called again for known txns; nothing changed
+                    continue
                 cur_hist.add(txid)
                 self._history_local[addr] = cur_hist
+                self._address_history_cache.pop(addr, None)
                 self._mark_address_history_changed(addr)
 
     def _remove_tx_from_local_history(self, txid):
@@ -661,12 +869,43 @@ class AddressSynchronizer(PrintError):
                     pass
                 else:
                     self._history_local[addr] = cur_hist
+                    self._address_history_cache.pop(addr, None)
+
+    def _tx_height_changed(self, txid):
+        # call with self.lock held, right after changing verified_tx/unverified_tx
+        self._unverified_tx_snapshot = None
+        with self.transaction_lock:
+            for addr in itertools.chain(self.txi.get(txid, []), self.txo.get(txid, [])):
+                self._address_history_cache.pop(addr, None)
+                self._addr_balance_cache.pop(addr, None)
+                self._addr_balance_dirty.add(addr)
+
+    def _touch_addrs(self, addrs):
+        # call with self.transaction_lock held, when txi/txo of addrs change
+        for addr in addrs:
+            self._addr_balance_cache.pop(addr, None)
+            self._addr_received_cache.pop(addr, None)
+            self._addr_empty_cache.pop(addr, None)
+            self._addr_balance_dirty.add(addr)
+
+    def _reset_wallet_balance(self):
+        # running total of get_balance() over the whole wallet: (local_height, (c, u, x)),
+        # or None when it has to be recomputed (e.g. addresses were added or removed)
+        self._wallet_balance = None
+        # address -> (c, u, x) included in _wallet_balance
+        self._wallet_balance_parts = {}
+        # addresses whose balance may have changed since _wallet_balance was updated
+        self._addr_balance_dirty = set()
 
     def _mark_address_history_changed(self, addr: str) -> None:
+        event = self._address_history_changed_events.get(addr)
+        if event is None:
+            # nobody is waiting on this address
+            return
         # history for this address changed, wake up coroutines:
-        self._address_history_changed_events[addr].set()
+        event.set()
         # clear event immediately so that coroutines can wait() for the next change:
-        self._address_history_changed_events[addr].clear()
+        event.clear()
 
     async def wait_for_address_history_to_change(self, addr: str) -> None:
         """Wait until the server tells us about a new transaction related to addr.
@@ -681,54 +920,102 @@ class AddressSynchronizer(PrintError):
         if tx_hash in self.verified_tx:
             if tx_height in (TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT):
                 with self.lock:
-                    self.verified_tx.pop(tx_hash)
+                    self._pop_verified_tx(tx_hash)
+                    self._tx_height_changed(tx_hash)
                 if self.verifier:
                     self.verifier.remove_spv_proof_for_tx(tx_hash)
         else:
             with self.lock:
                 # tx will be verified only if height > 0
-                self.unverified_tx[tx_hash] = tx_height
+                if self.unverified_tx.get(tx_hash) != tx_height:
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._tx_height_changed(tx_hash)
 
     def remove_unverified_tx(self, tx_hash, tx_height):
         with self.lock:
             new_height = self.unverified_tx.get(tx_hash)
             if new_height == tx_height:
                 self.unverified_tx.pop(tx_hash, None)
+                self._tx_height_changed(tx_hash)
 
     def add_verified_tx(self, tx_hash: str, info: TxMinedInfo):
         # Remove from the unverified map and add to the verified map
         with self.lock:
+            # add before removing, see _lookup_tx
+            self._set_verified_tx(tx_hash, info)
             self.unverified_tx.pop(tx_hash, None)
-            self.verified_tx[tx_hash] = info
+            self._tx_height_changed(tx_hash)
         tx_mined_status = self.get_tx_height(tx_hash)
         self.network.trigger_callback('verified', self, tx_hash, tx_mined_status)
 
+    def _set_verified_tx(self, tx_hash: str, info: TxMinedInfo):
+        # call with self.lock held
+        old_info = self.verified_tx.get(tx_hash)
+        self.verified_tx[tx_hash] = info
+        self._verified_tx_serialized[tx_hash] = (info.height, info.timestamp,
+                                                 info.txpos, info.header_hash)
+        if old_info is not None and old_info.height != info.height:
+            self._discard_verified_tx_height(tx_hash, old_info.height)
+        self._verified_tx_by_height[info.height].add(tx_hash)
+
+    def _pop_verified_tx(self, tx_hash: str) -> Optional[TxMinedInfo]:
+        # call with self.lock held
+        self._verified_tx_serialized.pop(tx_hash, None)
+        info = self.verified_tx.pop(tx_hash, None)
+        if info is not None:
+            self._discard_verified_tx_height(tx_hash, info.height)
+        return info
+
+    def _discard_verified_tx_height(self, tx_hash: str, height: int):
+        # call with self.lock held
+        txids = self._verified_tx_by_height.get(height)
+        if txids is not None:
+            txids.discard(tx_hash)
+            if not txids:
+                del self._verified_tx_by_height[height]
+
     def get_unverified_txs(self):
-        '''Returns a map from tx hash to transaction height'''
-        with self.lock:
-            return dict(self.unverified_tx)  # copy
+        '''Returns a map from tx hash to transaction height.
+        The map is shared between callers and must not be modified.'''
+        # the verifier polls this several times per second, while the map
+        # rarely changes; only copy it again after a change
+        snapshot = self._unverified_tx_snapshot
+        if snapshot is None:
+            # under self.lock, so a concurrent change cannot be overwritten
+            # with a snapshot taken before it
+            with self.lock:
+                snapshot = self._unverified_tx_snapshot = dict(self.unverified_tx)
+        return snapshot
 
     def undo_verifications(self, blockchain, height):
         '''Used by the verifier when a reorg has happened'''
         txs = set()
         with self.lock:
-            for tx_hash, info in list(self.verified_tx.items()):
-                tx_height = info.height
-                if tx_height >= height:
-                    header = blockchain.read_header(tx_height)
-                    if not header or hash_header(header) != info.header_hash:
-                        self.verified_tx.pop(tx_hash, None)
-                        # NOTE: we should add these txns to self.unverified_tx,
-                        # but with what height?
-                        # If on the new fork after the reorg, the txn is at the
-                        # same height, we will not get a status update for the
-                        # address. If the txn is not mined or at a diff height,
-                        # we should get a status update. Unless we put tx into
-                        # unverified_tx, it will turn into local. So we put it
-                        # into unverified_tx with the old height, and if we get
-                        # a status update, that will overwrite it.
-                        self.unverified_tx[tx_hash] = tx_height
-                        txs.add(tx_hash)
+            affected = [(tx_height, list(txids))
+                        for tx_height, txids in self._verified_tx_by_height.items()
+                        if tx_height >= height]
+            for tx_height, txids in affected:
+                # read and hash each header once, for all txs at that height
+                header = blockchain.read_header(tx_height)
+                header_hash = hash_header(header) if header else None
+                for tx_hash in txids:
+                    info = self.verified_tx[tx_hash]
+                    if header and header_hash == info.header_hash:
+                        continue
+                    # NOTE: we should add these txns to self.unverified_tx,
+                    # but with what height?
+                    # If on the new fork after the reorg, the txn is at the
+                    # same height, we will not get a status update for the
+                    # address. If the txn is not mined or at a diff height,
+                    # we should get a status update. Unless we put tx into
+                    # unverified_tx, it will turn into local. So we put it
+                    # into unverified_tx with the old height, and if we get
+                    # a status update, that will overwrite it.
+                    # (added before removing from verified_tx, see _lookup_tx)
+                    self.unverified_tx[tx_hash] = tx_height
+                    self._pop_verified_tx(tx_hash)
+                    self._tx_height_changed(tx_hash)
+                    txs.add(tx_hash)
         return txs
 
     def get_local_height(self):
@@ -738,18 +1025,33 @@ class AddressSynchronizer(PrintError):
             return cached_local_height
         return self.network.get_local_height() if self.network else self.storage.get('stored_height', 0)
 
+    def _lookup_tx(self, tx_hash: str):
+        """Returns (TxMinedInfo, None) if tx_hash is verified, (None, height)
+        if it is unverified, and (None, None) if it is local.
+
+        This does not take self.lock. Writers hold self.lock and, when moving
+        a tx between verified_tx and unverified_tx, add it to the new map
+        before removing it from the old one. The second verified_tx lookup
+        catches a tx that moved to verified_tx between the first two lookups.
+        """
+        info = self.verified_tx.get(tx_hash)
+        if info is not None:
+            return info, None
+        height = self.unverified_tx.get(tx_hash)
+        if height is not None:
+            return None, height
+        return self.verified_tx.get(tx_hash), None
+
     def get_tx_height(self, tx_hash: str) -> TxMinedInfo:
-        with self.lock:
-            if tx_hash in self.verified_tx:
-                info = self.verified_tx[tx_hash]
-                conf = max(self.get_local_height() - info.height + 1, 0)
-                return info._replace(conf=conf)
-            elif tx_hash in self.unverified_tx:
-                height = self.unverified_tx[tx_hash]
-                return TxMinedInfo(height=height, conf=0)
-            else:
-                # local transaction
-                return TxMinedInfo(height=TX_HEIGHT_LOCAL, conf=0)
+        info, height = self._lookup_tx(tx_hash)
+        if info is not None:
+            conf = max(self.get_local_height() - info.height + 1, 0)
+            return info._replace(conf=conf)
+        elif height is not None:
+            return TxMinedInfo(height=height, conf=0)
+        else:
+            # local transaction
+            return TxMinedInfo(height=TX_HEIGHT_LOCAL, conf=0)
 
     def set_up_to_date(self, up_to_date):
         with self.lock:
@@ -764,37 +1066,65 @@ class AddressSynchronizer(PrintError):
                 self.save_verified_tx(write=True)
 
     def is_up_to_date(self):
-        with self.lock: return self.up_to_date
+        # reading a single attribute needs no lock
+        return self.up_to_date
 
     @with_transaction_lock
     def get_tx_delta(self, tx_hash, address):
         """effect of tx on address"""
-        delta = 0
         # substract the value of coins sent from address
-        d = self.txi.get(tx_hash, {}).get(address, [])
-        for n, v in d:
-            delta -= v
+        sent = sum(map(_txi_value, self.txi.get(tx_hash, {}).get(address, ())))
         # add the value of the coins received at address
-        d = self.txo.get(tx_hash, {}).get(address, [])
-        for n, v, cb in d:
-            delta += v
+        received = sum(map(_txo_value, self.txo.get(tx_hash, {}).get(address, {}).values()))
+        return received - sent
+
+    @with_transaction_lock
+    def get_tx_domain_delta(self, tx_hash, domain):
+        """effect of tx on the addresses in domain (a set)"""
+        delta = 0
+        for addr, d in self.txi.get(tx_hash, {}).items():
+            if addr in domain:
+                delta -= sum(map(_txi_value, d))
+        for addr, d in self.txo.get(tx_hash, {}).items():
+            if addr in domain:
+                delta += sum(map(_txo_value, d.values()))
         return delta
 
     @with_transaction_lock
-    def get_omni_delta(self, tx_hash, address):
-        """effect of tx on address"""
-        if not hasattr(self, 'omni'):
+    def get_omni_domain_delta(self, tx_hash, domain):
+        """omni effect of tx on the addresses in domain (a set)"""
+        if not self.omni or not tx_hash in self.omni_tx:
             return 0
+        addrs = set(self.txi.get(tx_hash, ())) | set(self.txo.get(tx_hash, ()))
+        return sum(self.get_omni_delta(tx_hash, addr) for addr in addrs & domain)
+
+    def _get_omni_delta_disabled(self, tx_hash, address):
+        return 0
+
+    @with_transaction_lock
+    def _get_omni_delta(self, tx_hash, address):
+        """effect of tx on address.
+        installed as get_omni_delta in __init__ for omni wallets
+        """
         # substract the value of coins sent from address
         if not tx_hash in self.omni_tx:
             return 0
-        tx_data = self.omni_tx[tx_hash]
-        if (not 'amount' in tx_data) or (not 'sender' in tx_data) or (not 'reference' in tx_data):
+        try:
+            amount = self._omni_amount_cache[tx_hash]
+        except KeyError:
+            # parse the amount once, not on every history row
+            tx_data = self.omni_tx[tx_hash]
+            if not tx_data.keys() >= _OMNI_REQUIRED_KEYS:
+                amount = None
+            else:
+                amount = (tx_data['sender'], tx_data['reference'], Decimal(tx_data['amount']))
+            self._omni_amount_cache[tx_hash] = amount
+        if amount is None:
             return 0
-        value = Decimal(tx_data['amount'])
-        if tx_data['sender'] == address:
+        sender, reference, value = amount
+        if sender == address:
             return -value
-        if tx_data['reference'] == address:
+        if reference == address:
             return value
         return 0
 
@@ -802,15 +1132,30 @@ class AddressSynchronizer(PrintError):
     @with_transaction_lock
     def get_tx_value(self, txid):
         """effect of tx on the entire domain"""
+        delta = self._tx_value_cache.get(txid)
+        if delta is not None:
+            return delta
         delta = 0
-        for addr, d in self.txi.get(txid, {}).items():
-            for n, v in d:
-                delta -= v
-        for addr, d in self.txo.get(txid, {}).items():
-            for n, v, cb in d:
-                delta += v
+        for d in self.txi.get(txid, {}).values():
+            delta -= sum(map(_txi_value, d))
+        for d in self.txo.get(txid, {}).values():
+            delta += sum(map(_txo_value, d.values()))
+        self._tx_value_cache[txid] = delta
         return delta
 
+    def _get_input_addresses(self, tx: Transaction):
+        # cached on tx; an address that is not known yet (None) is looked up
+        # again next time, as the funding tx may have been added meanwhile
+        inputs = tx.inputs()
+        addrs = getattr(tx, '_input_addresses', None)
+        if addrs is None or len(addrs) != len(inputs) or None in addrs:
+            if addrs is None or len(addrs) != len(inputs):
+                addrs = [None] * len(inputs)
+            addrs = [addr if addr is not None else self.get_txin_address(txin)
+                     for txin, addr in zip(inputs, addrs)]
+            tx._input_addresses = addrs
+        return addrs
+
     def get_wallet_delta(self, tx: Transaction):
         """ effect of tx on wallet """
         is_relevant = False  # "related to wallet?"
@@ -818,29 +1163,31 @@ class AddressSynchronizer(PrintError):
         is_pruned = False
         is_partial = False
         v_in = v_out = v_out_mine = 0
-        for txin in tx.inputs():
-            addr = self.get_txin_address(txin)
-            if self.is_mine(addr):
+        outpoint_to_txout = self.outpoint_to_txout
+        # address -> is_mine; consolidations and payouts repeat addresses a lot
+        mine = {}
+        for txin, addr in zip(tx.inputs(), self._get_input_addresses(tx)):
+            addr_is_mine = mine.get(addr)
+            if addr_is_mine is None:
+                addr_is_mine = mine[addr] = self.is_mine(addr)
+            if addr_is_mine:
                 is_mine = True
                 is_relevant = True
-                d = self.txo.get(txin['prevout_hash'], {}).get(addr, [])
-                for n, v, cb in d:
-                    if n == txin['prevout_n']:
-                        value = v
-                        break
-                else:
-                    value = None
-                if value is None:
+                txout = outpoint_to_txout.get((txin['prevout_hash'], txin['prevout_n']))
+                if txout is None or txout[0] != addr:
                     is_pruned = True
                 else:
-                    v_in += value
+                    v_in += txout[1]
             else:
                 is_partial = True
         if not is_mine:
             is_partial = False
         for o in tx.outputs():
             v_out += o.value
-            if self.is_mine(o.address):
+            addr_is_mine = mine.get(o.address)
+            if addr_is_mine is None:
+                addr_is_mine = mine[o.address] = self.is_mine(o.address)
+            if addr_is_mine:
                 v_out_mine += o.value
                 is_relevant = True
         if is_pruned:
@@ -868,7 +1215,8 @@ class AddressSynchronizer(PrintError):
             return None
         if hasattr(tx, '_cached_fee'):
             return tx._cached_fee
-        with self.lock, self.transaction_lock:
+        # get_wallet_delta only reads txi/txo data, not tx heights
+        with self.transaction_lock:
             is_relevant, is_mine, v, fee = self.get_wallet_delta(tx)
             if fee is None:
                 txid = tx.txid()
@@ -879,32 +1227,40 @@ class AddressSynchronizer(PrintError):
         return fee
 
     def get_addr_io(self, address):
-        with self.lock, self.transaction_lock:
-            h = self.get_address_history(address)
+        # the history and txi/txo are read in one transaction_lock scope, so that
+        # every prevout in sent is also in received. get_address_history could
+        # take self.lock on a cache miss, so it is not used here; get_tx_height
+        # does not take self.lock.
+        with self.transaction_lock:
+            h = self._address_history_cache.get(address)
+            if h is None:
+                h = [(tx_hash, self.get_tx_height(tx_hash).height)
+                     for tx_hash in self._history_local.get(address, ())]
             received = {}
             sent = {}
+            txi = self.txi
+            txo = self.txo
             for tx_hash, height in h:
-                l = self.txo.get(tx_hash, {}).get(address, [])
-                for n, v, is_cb in l:
-                    received[tx_hash + ':%d'%n] = (height, v, is_cb)
-            for tx_hash, height in h:
-                l = self.txi.get(tx_hash, {}).get(address, [])
-                for txi, v in l:
-                    sent[txi] = height
+                l = txo.get(tx_hash, {}).get(address, {})
+                for n, (v, is_cb) in l.items():
+                    received[(tx_hash, n)] = (height, v, is_cb)
+                l = txi.get(tx_hash, {}).get(address, ())
+                for prevout, v in l:
+                    sent[prevout] = height
         return received, sent
 
     def get_addr_utxo(self, address):
         coins, spent = self.get_addr_io(address)
-        for txi in spent:
-            coins.pop(txi)
+        for prevout in spent:
+            coins.pop(prevout)
         out = {}
         for txo, v in coins.items():
             tx_height, value, is_cb = v
-            prevout_hash, prevout_n = txo.split(':')
+            prevout_hash, prevout_n = txo
             x = {
                 'address':address,
                 'value':value,
-                'prevout_n':int(prevout_n),
+                'prevout_n':prevout_n,
                 'prevout_hash':prevout_hash,
                 'height':tx_height,
                 'coinbase':is_cb
@@ -914,71 +1270,153 @@ class AddressSynchronizer(PrintError):
 
     # return the total amount ever received by an address
     def get_addr_received(self, address):
-        received, sent = self.get_addr_io(address)
-        return sum([v for height, v, is_cb in received.values()])
+        # lock-free on a cache hit, see _get_balance
+        received = self._addr_received_cache.get(address)
+        if received is None:
+            # get_addr_io takes self.lock too; keep the lock order
+            with self.lock, self.transaction_lock:
+                received, sent = self.get_addr_io(address)
+                received = sum([v for height, v, is_cb in received.values()])
+                self._addr_received_cache[address] = received
+        return received
 
     @with_local_height_cached
     def get_addr_balance(self, address):
         """Return the balance of a bitcoin address:
         confirmed and matured, unconfirmed, unmatured
         """
-        received, sent = self.get_addr_io(address)
-        c = u = x = 0
+        return self._get_balance((address,))
+
+    def _get_balance(self, domain):
+        # one walk over the history of the domain addresses, reading txi/txo
+        # directly instead of building get_addr_io dicts per address.
+        # per-address results are cached; a result also depends on local_height
+        # (coinbase maturity), so it is only reused for the same local_height.
+        # cache entries are only written and dropped with transaction_lock held,
+        # and each entry is stored as one complete value, so cache hits are read
+        # without taking the locks, like get_address_history
+        cc = uu = xx = 0
         local_height = self.get_local_height()
-        for txo, (tx_height, v, is_cb) in received.items():
-            if is_cb and tx_height + COINBASE_MATURITY > local_height:
-                x += v
-            elif tx_height > 0:
-                c += v
+        missing = []
+        for addr in domain:
+            cached = self._addr_balance_cache.get(addr)
+            if cached is not None and cached[0] == local_height:
+                c, u, x = cached[1]
+                cc += c
+                uu += u
+                xx += x
             else:
-                u += v
-            if txo in sent:
-                if sent[txo] > 0:
-                    c -= v
-                else:
-                    u -= v
-        return c, u, x
+                missing.append(addr)
+        if not missing:
+            return cc, uu, xx
+        tx_heights = {}
+        # coinbase outputs mined above this height are not mature yet
+        immature_above = local_height - COINBASE_MATURITY
+        with self.lock, self.transaction_lock:
+            txi = self.txi
+            txo = self.txo
+            outpoint_to_txout = self.outpoint_to_txout
+            for addr in missing:
+                c = u = x = 0
+                for tx_hash in self._history_local.get(addr, ()):
+                    tx_height = tx_heights.get(tx_hash)
+                    if tx_height is None:
+                        tx_height = tx_heights[tx_hash] = self.get_tx_height(tx_hash).height
+                    for v, is_cb in txo.get(tx_hash, {}).get(addr, {}).values():
+                        if is_cb and tx_height > immature_above:
+                            x += v
+                        elif tx_height > 0:
+                            c += v
+                        else:
+                            u += v
+                    for prevout, v in txi.get(tx_hash, {}).get(addr, ()):
+                        # only coins we still have the funding tx of were counted above
+                        if prevout not in outpoint_to_txout:
+                            continue
+                        if tx_height > 0:
+                            c -= v
+                        else:
+                            u -= v
+                self._addr_balance_cache[addr] = (local_height, (c, u, x))
+                cc += c
+                uu += u
+                xx += x
+        return cc, uu, xx
 
     @with_local_height_cached
     def get_utxos(self, domain=None, excluded=None, mature=False, confirmed_only=False, nonlocal_only=False):
         coins = []
         if domain is None:
+            # wallet addresses are already unique
             domain = self.get_addresses()
-        domain = set(domain)
+        else:
+            domain = set(domain)
         if excluded:
-            domain = set(domain) - excluded
-        for addr in domain:
-            utxos = self.get_addr_utxo(addr)
-            for x in utxos.values():
-                if confirmed_only and x['height'] <= 0:
-                    continue
-                if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
-                    continue
-                if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > self.get_local_height():
-                    continue
-                coins.append(x)
-                continue
+            # excluded is a set (e.g. frozen_addresses)
+            domain = [addr for addr in domain if addr not in excluded]
+        local_height = self.get_local_height()
+        # hold the locks once for the whole domain, instead of
+        # re-acquiring them in get_addr_io for every address
+        with self.lock, self.transaction_lock:
+            for addr in domain:
+                utxos = self.get_addr_utxo(addr)
+                for x in utxos.values():
+                    if confirmed_only and x['height'] <= 0:
+                        continue
+                    if nonlocal_only and x['height'] == TX_HEIGHT_LOCAL:
+                        continue
+                    if mature and x['coinbase'] and x['height'] + COINBASE_MATURITY > local_height:
+                        continue
+                    coins.append(x)
         return coins
 
+    @with_local_height_cached
     def get_balance(self, domain=None):
         if domain is None:
-            domain = self.get_addresses()
-        domain = set(domain)
-        cc = uu = xx = 0
-        for addr in domain:
-            c, u, x = self.get_addr_balance(addr)
-            cc += c
-            uu += u
-            xx += x
-        return cc, uu, xx
+            return self._get_wallet_balance()
+        return self._get_balance(set(domain))
+
+    def _get_wallet_balance(self):
+        local_height = self.get_local_height()
+        total = self._wallet_balance
+        if total is not None and total[0] == local_height and not self._addr_balance_dirty:
+            return total[1]
+        with self.lock, self.transaction_lock:
+            total = self._wallet_balance
+            if total is None or total[0] != local_height:
+                parts = {addr: self._get_balance((addr,)) for addr in self.get_addresses()}
+                c = sum(b[0] for b in parts.values())
+                u = sum(b[1] for b in parts.values())
+                x = sum(b[2] for b in parts.values())
+                self._wallet_balance_parts = parts
+            else:
+                # fold in the addresses that changed since the last call
+                c, u, x = total[1]
+                parts = self._wallet_balance_parts
+                for addr in self._addr_balance_dirty:
+                    old = parts.get(addr)
+                    if old is None:
+                        # not a wallet address
+                        continue
+                    new = parts[addr] = self._get_balance((addr,))
+                    c += new[0] - old[0]
+                    u += new[1] - old[1]
+                    x += new[2] - old[2]
+            self._addr_balance_dirty = set()
+            self._wallet_balance = (local_height, (c, u, x))
+            return c, u, x
 
     def is_used(self, address):
         h = self.history.get(address,[])
         return len(h) != 0
 
     def is_empty(self, address):
-        c, u, x = self.get_addr_balance(address)
-        return c+u+x == 0
+        empty = self._addr_empty_cache.get(address)
+        if empty is None:
+            with self.lock, self.transaction_lock:
+                c, u, x = self.get_addr_balance(address)
+                empty = self._addr_empty_cache[address] = c+u+x == 0
+        return empty
 
     def synchronize(self):
         pass
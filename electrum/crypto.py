@@ -193,8 +193,9 @@ def sha256(x: Union[bytes, str]) -> bytes:
 
 def sha256d(x: Union[bytes, str]) -> bytes:
     x = to_bytes(x, 'utf8')
-    out = bytes(sha256(sha256(x)))
-    return out
+    # hashlib's digest() is already bytes; going through sha256() twice
+    # would re-check the input type and copy the digest each time
+    return hashlib.sha256(hashlib.sha256(x).digest()).digest()
 
 
 def hash_160(x: bytes) -> bytes:
@@ -15,9 +15,7 @@ class RPCHostOmni():
     def set_url(self, daemon_url):
         self._url = daemon_url
 
-    def call(self, rpcMethod, *params):
-        self.id += 1
-        payload = json.dumps({"id": str(self.id), "method": rpcMethod, "params": list(params), "jsonrpc": "2.0"})
+    def _post(self, payload):
         tries = 10
         hadConnectionFailures = False
         while True:
@@ -43,12 +41,37 @@ class RPCHostOmni():
             raise Exception('RPC connection failure: ' + str(response.status_code) + ' ' + response.reason)
         # confirm the response was received
         self.connected = True
+        return response
+
+    def call(self, rpcMethod, *params):
+        self.id += 1
+        payload = json.dumps({"id": str(self.id), "method": rpcMethod, "params": list(params), "jsonrpc": "2.0"})
+        response = self._post(payload)
         responseJSON = response.json()
         if 'error' in responseJSON and responseJSON['error'] != None:
             raise Exception('Error in ' + rpcMethod + ' RPC call: ' + str(responseJSON['error']))
         # return responseJSON['result']
         return responseJSON
 
+    def batch_call(self, calls):
+        """Send a list of (rpcMethod, params) in a single JSON-RPC batch request.
+        Responses are returned in the order of calls. Errors of individual
+        calls are not raised, check the 'error' field of each response.
+        """
+        batch = []
+        for rpcMethod, params in calls:
+            self.id += 1
+            batch.append({"id": str(self.id), "method": rpcMethod, "params": list(params), "jsonrpc": "2.0"})
+        if not batch:
+            return []
+        response = self._post(json.dumps(batch))
+        responseJSON = response.json()
+        if not isinstance(responseJSON, list):
+            raise Exception('Error in batch RPC call: ' + str(responseJSON.get('error')))
+        by_id = {r.get('id'): r for r in responseJSON}
+        missing = {'result': None, 'error': 'no response'}
+        return [by_id.get(r['id'], missing) for r in batch]
+
     # Bitcoin Generic RPC calls
     def importAddress(self, addr):
         return self.call("importaddress", addr)
@@ -81,6 +104,9 @@ class RPCHostOmni():
     def getBalance(self, addr, propertyid):
         return self.call("omni_getbalance", addr, propertyid)
 
+    def getBalances(self, addrs, propertyid):
+        return self.batch_call([("omni_getbalance", (addr, propertyid)) for addr in addrs])
+
     def getAllBalancesForAddress(self, addr):
         return self.call("omni_getallbalancesforaddress", addr)
 
@@ -90,6 +116,9 @@ class RPCHostOmni():
     def decodeTransaction(self, rawtx):
         return self.call("omni_decodetransaction", rawtx)
 
+    def decodeTransactions(self, rawtxs):
+        return self.batch_call([("omni_decodetransaction", (rawtx,)) for rawtx in rawtxs])
+
     def listProperties(self):
         return self.call("omni_listproperties")
 
@@ -86,6 +86,14 @@ class JsonDB(PrintError):
                 v = copy.deepcopy(v)
         return v
 
+    def get_nocopy(self, key, default=None):
+        """Like get, but without the deepcopy. The caller must not modify the result."""
+        with self.db_lock:
+            v = self.data.get(key)
+            if v is None:
+                v = default
+        return v
+
     def put(self, key, value):
         try:
             json.dumps(key, cls=util.MyEncoder)
@@ -102,6 +110,18 @@ class JsonDB(PrintError):
                 self.modified = True
                 self.data.pop(key)
 
+    def put_nocopy(self, key, value):
+        """Like put, but stores value itself; it is not checked, compared or
+        copied. The caller must pass a freshly built, json-serializable value,
+        must not modify it afterwards, and should only call this if it changed."""
+        with self.db_lock:
+            if value is not None:
+                self.modified = True
+                self.data[key] = value
+            elif key in self.data:
+                self.modified = True
+                self.data.pop(key)
+
     def get_all_data(self) -> dict:
         with self.db_lock:
             return copy.deepcopy(self.data)
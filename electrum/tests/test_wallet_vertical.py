@@ -1,15 +1,17 @@
 from unittest import mock
 import shutil
+import json
 import tempfile
+from decimal import Decimal
 from typing import Sequence
 import asyncio
 
 from electrum import storage, bitcoin, keystore, bip32
 from electrum import Transaction
 from electrum import SimpleConfig
-from electrum.address_synchronizer import TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT
+from electrum.address_synchronizer import AddressSynchronizer, TX_HEIGHT_UNCONFIRMED, TX_HEIGHT_UNCONF_PARENT, TX_HEIGHT_LOCAL
 from electrum.wallet import sweep, Multisig_Wallet, Standard_Wallet, Imported_Wallet
-from electrum.util import bfh, bh2u
+from electrum.util import bfh, bh2u, TxMinedInfo
 from electrum.transaction import TxOutput
 
 from electrum.plugins.trustedcoin import trustedcoin
@@ -1670,6 +1672,14 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
         w.create_new_address(for_change=True)
         return w
 
+    @classmethod
+    def create_synced_wallet(cls):
+        w = cls.create_old_wallet()
+        for i in [2, 12, 7, 9, 11, 10, 16, 6, 17, 1, 13, 15, 5, 8, 4, 0, 14, 18, 3]:
+            tx = Transaction(cls.transactions[cls.txid_list[i]])
+            w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
+        return w
+
     @mock.patch.object(storage.WalletStorage, '_write')
     def test_restoring_old_wallet_txorder1(self, mock_write):
         w = self.create_old_wallet()
@@ -1694,6 +1704,204 @@ class TestWalletHistory_SimpleRandomOrder(TestCaseForTestnet):
             w.receive_tx_callback(tx.txid(), tx, TX_HEIGHT_UNCONFIRMED)
         self.assertEqual(27633300, sum(w.get_balance()))
 
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_reloading_txo_from_storage(self, mock_write):
+        w = self.create_synced_wallet()
+        w.save_transactions()
+        # round-trip through json, as when reading the wallet file from disk
+        txo = json.loads(json.dumps(w.storage.get('txo')))
+        # the file keeps the list form older versions read
+        for d in txo.values():
+            for outputs in d.values():
+                self.assertIsInstance(outputs, list)
+        w.storage.put('txo', txo)
+        w.load_transactions()
+        w.load_local_history()
+        self.assertEqual(27633300, sum(w.get_balance()))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_reloading_spent_outpoints_from_storage(self, mock_write):
+        w = self.create_synced_wallet()
+        spent_outpoints = dict(w.spent_outpoints)
+        w.save_transactions()
+        # round-trip through json, as when reading the wallet file from disk
+        w.storage.put('spent_outpoints', json.loads(json.dumps(w.storage.get('spent_outpoints'))))
+        w.load_transactions()
+        self.assertEqual(spent_outpoints, w.spent_outpoints)
+        parent = '2791cdc98570cc2b6d9d5b197dc2d002221b074101e3becb19fab4b79150446d'
+        self.assertEqual(4, len(w.get_depending_transactions(parent)))
+        # spends of the outputs of a removed tx are kept, so its children are still found
+        w.remove_transaction(parent)
+        self.assertEqual(4, len(w.get_depending_transactions(parent)))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_addr_balances(self, mock_write):
+        w = self.create_synced_wallet()
+        balances = {addr: w.get_addr_balance(addr) for addr in w.get_addresses()
+                    if any(w.get_addr_balance(addr))}
+        self.assertEqual({
+            'mupBXEDhWQnrmyW4TukDs2qcqQrhRJGrQd': (0, 15000000, 0),
+            'mpEGnkPKtMyfHo8EaUFks7xFZJdSgLjnC7': (0, 1000000, 0),
+            'mgaArVGf5heGUko1i24wYrvkfFcN442U4v': (0, 4978900, 0),
+            'mwNWMKSGou8ZJzXgfDaAUy1C8Jip3TEmdf': (0, 100000, 0),
+            'n23NSQfgAmVaW1qE1kgnxkW8JvWfveAktH': (0, 3999400, 0),
+            'mvXwR94pXVgP7kdrW3vTiDQtVrkP3NY3zn': (0, 1866000, 0),
+            'mp2CafXnWnN8rR6BnFToVQ8bXNY4jnAecr': (0, 689000, 0),
+        }, balances)
+        self.assertEqual((0, 27633300, 0), w.get_balance())
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_history_deltas(self, mock_write):
+        w = self.create_synced_wallet()
+        history = w.get_history()
+        self.assertEqual(len(self.txid_list), len(history))
+        self.assertEqual(27633300, history[-1][3])
+        deltas = {tx_hash[:8]: delta for tx_hash, tx_mined_status, delta, *rest in history}
+        self.assertEqual(89998701, deltas['7f19935d'])
+        self.assertEqual(-79998701, deltas['6ae728f7'])
+        # a tx touching both domain and other wallet addresses only counts the domain side
+        domain = w.get_addresses()[:5]
+        history = w.get_history(domain)
+        deltas = {tx_hash[:8]: delta for tx_hash, tx_mined_status, delta, *rest in history}
+        self.assertEqual(10000000, deltas['6ae728f7'])
+        self.assertEqual(-19995259, deltas['0f4972c8'])
+        self.assertEqual(15000000, history[-1][3])
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_address_history_follows_tx_height(self, mock_write):
+        w = self.create_old_wallet()
+        tx = Transaction(self.transactions[self.txid_list[0]])
+        txid = tx.txid()
+        w.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        addr = next(iter(w.txo[txid]))
+        self.assertIn((txid, TX_HEIGHT_UNCONFIRMED), w.get_address_history(addr))
+        w.add_unverified_tx(txid, 1325000)
+        self.assertIn((txid, 1325000), w.get_address_history(addr))
+        w.remove_unverified_tx(txid, 1325000)
+        self.assertIn((txid, TX_HEIGHT_LOCAL), w.get_address_history(addr))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_cached_balance_follows_history(self, mock_write):
+        w = self.create_old_wallet()
+        tx = Transaction(self.transactions[self.txid_list[0]])
+        txid = tx.txid()
+        w.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        addr = next(iter(w.txo[txid]))
+        self.assertEqual((0, 19994800, 0), w.get_addr_balance(addr))
+        self.assertEqual(19994800, w.get_addr_received(addr))
+        self.assertFalse(w.is_empty(addr))
+        w.add_unverified_tx(txid, 1325000)
+        self.assertEqual((19994800, 0, 0), w.get_addr_balance(addr))
+        w.remove_transaction(txid)
+        self.assertEqual((0, 0, 0), w.get_addr_balance(addr))
+        self.assertEqual(0, w.get_addr_received(addr))
+        self.assertTrue(w.is_empty(addr))
+        w.receive_tx_callback(txid, tx, TX_HEIGHT_UNCONFIRMED)
+        self.assertEqual((0, 19994800, 0), w.get_addr_balance(addr))
+        self.assertEqual(19994800, w.get_addr_received(addr))
+        self.assertFalse(w.is_empty(addr))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_undo_verifications(self, mock_write):
+        w = self.create_old_wallet()
+        # two txs per block
+        heights = {txid: 1325000 + i // 2 for i, txid in enumerate(self.txid_list)}
+        for txid, height in heights.items():
+            tx = Transaction(self.transactions[txid])
+            w.receive_tx_callback(txid, tx, height)
+            with w.lock:
+                w._set_verified_tx(txid, TxMinedInfo(height=height, timestamp=0, txpos=0,
+                                                     header_hash='00' * 32))
+        blockchain = mock.Mock()
+        blockchain.read_header.return_value = None
+        undone = w.undo_verifications(blockchain, 1325005)
+        self.assertEqual({txid for txid, height in heights.items() if height >= 1325005}, undone)
+        # each affected height is read once, the ones below are not read at all
+        self.assertEqual(len({height for height in heights.values() if height >= 1325005}),
+                         blockchain.read_header.call_count)
+        for txid, height in heights.items():
+            if height < 1325005:
+                self.assertEqual(height, w.verified_tx[txid].height)
+            else:
+                self.assertNotIn(txid, w.verified_tx)
+                self.assertEqual(height, w.get_tx_height(txid).height)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_running_wallet_balance(self, mock_write):
+        w = self.create_old_wallet()
+        self.assertEqual((0, 0, 0), w.get_balance())
+        w = self.create_synced_wallet()
+        self.assertEqual((0, 27633300, 0), w.get_balance())
+        for i, txid in enumerate(self.txid_list):
+            w.add_unverified_tx(txid, 1325000 + i)
+        self.assertEqual((27633300, 0, 0), w.get_balance())
+        w.remove_transaction(self.txid_list[3])
+        self.assertEqual((37633300, 0, 0), w.get_balance())
+        # re-adding a known address keeps the running total
+        w.add_address(w.get_addresses()[0])
+        self.assertIsNotNone(w._wallet_balance)
+        self.assertEqual((37633300, 0, 0), w.get_balance())
+
+
+class TestOmniMarker(TestCaseForTestnet):
+
+    def _tx_with_output(self, output):
+        return Transaction.from_io([], [output, TxOutput(bitcoin.TYPE_ADDRESS, 'tb1qgh5c088he4d559wl0hw27hrdeg8p2z96pefn4q', 546)])
+
+    def test_class_c_payload(self):
+        payload = '6f6d6e69' + '0000000000000001' + '00000000000f4240'
+        script = '6a' + '%02x' % (len(payload) // 2) + payload
+        tx = self._tx_with_output(TxOutput(bitcoin.TYPE_SCRIPT, script, 0))
+        self.assertTrue(AddressSynchronizer.tx_may_be_omni(tx))
+        script = '6a4c' + '%02x' % (len(payload) // 2) + payload
+        tx = self._tx_with_output(TxOutput(bitcoin.TYPE_SCRIPT, script, 0))
+        self.assertTrue(AddressSynchronizer.tx_may_be_omni(tx))
+
+    def test_exodus_output(self):
+        tx = self._tx_with_output(TxOutput(bitcoin.TYPE_ADDRESS, 'mpexoDuSkGGqvqrkrjiFng38QPkJQVFyqv', 546))
+        self.assertTrue(AddressSynchronizer.tx_may_be_omni(tx))
+
+    def test_plain_transactions(self):
+        tx = self._tx_with_output(TxOutput(bitcoin.TYPE_SCRIPT, '6a0568656c6c6f', 0))
+        self.assertFalse(AddressSynchronizer.tx_may_be_omni(tx))
+        tx = self._tx_with_output(TxOutput(bitcoin.TYPE_ADDRESS, 'tb1qm0ejr6g964zt2jux5te7m9ds43n28hdsdz9ull', 1000))
+        self.assertFalse(AddressSynchronizer.tx_may_be_omni(tx))
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_balance_cache(self, mock_write):
+        ks = keystore.from_xpub('vpub5Vhmk4dEJKanDTTw6immKXa3thw45u3gbd1rPYjREB6viP13sVTWcH6kvbR2YeLtGjradr6SFLVt9PxWDBSrvw1Dc1nmd3oko3m24CQbfaJ')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        w.omni_property = '1'
+        w.omni_daemon = mock.Mock()
+        w.omni_daemon.getBalances.side_effect = \
+            lambda addrs, propertyid: [{'result': {'balance': '1.5'}} for addr in addrs]
+        addrs = w.get_receiving_addresses()
+        self.assertEqual(Decimal('3'), w.omni_addr_balance(addrs))
+        self.assertEqual(Decimal('3'), w.omni_addr_balance(addrs))
+        self.assertEqual(1, w.omni_daemon.getBalances.call_count)
+        # adding or removing a transaction drops the cached balances
+        w.remove_transaction('511a35e240f4c8855de4c548dad932d03611a37e94e9203fdb6fc79911fe1dd4')
+        self.assertEqual(Decimal('3'), w.omni_addr_balance(addrs))
+        self.assertEqual(2, w.omni_daemon.getBalances.call_count)
+        # balances of another property are not taken from the cache
+        w.omni_property = '31'
+        self.assertEqual(Decimal('3'), w.omni_addr_balance(addrs))
+        self.assertEqual(3, w.omni_daemon.getBalances.call_count)
+
+    @mock.patch.object(storage.WalletStorage, '_write')
+    def test_omni_delta(self, mock_write):
+        ks = keystore.from_xpub('vpub5Vhmk4dEJKanDTTw6immKXa3thw45u3gbd1rPYjREB6viP13sVTWcH6kvbR2YeLtGjradr6SFLVt9PxWDBSrvw1Dc1nmd3oko3m24CQbfaJ')
+        w = WalletIntegrityHelper.create_standard_wallet(ks, gap_limit=2)
+        sender, reference = w.get_receiving_addresses()
+        w.omni_tx = {'aa': {'sender': sender, 'reference': reference, 'amount': '0.25'},
+                     'bb': {'sender': sender}}
+        # not an omni wallet: no token deltas at all
+        self.assertEqual(0, w.get_omni_delta('aa', sender))
+        self.assertEqual(Decimal('-0.25'), w._get_omni_delta('aa', sender))
+        self.assertEqual(Decimal('0.25'), w._get_omni_delta('aa', reference))
+        self.assertEqual(0, w._get_omni_delta('bb', sender))
+        self.assertEqual(0, w._get_omni_delta('cc', sender))
+
 
 class TestWalletHistory_EvilGapLimit(TestCaseForTestnet):
     transactions = {
@@ -255,13 +255,8 @@ class Abstract_Wallet(AddressSynchronizer):
         self.omni_daemon.set_url(daemon_url)
 
     def omni_getname(self, property_id):
-        try:
-            prop = self.omni_daemon.getProperty(property_id)
-            res = prop['result']
-            name = res['name']
-        except:
-            name = "token_%d" % property_id
-        return name
+        # without an omni daemon, fall back to a generic name
+        return super().omni_getname(property_id) or "token_%d" % property_id
 
     def omni_format_amount(self, amount):
         if amount == 0:
@@ -674,9 +669,7 @@ class Abstract_Wallet(AddressSynchronizer):
             is_final = tx and tx.is_final()
             if not is_final:
                 extra.append('rbf')
-            fee = self.get_wallet_delta(tx)[3]
-            if fee is None:
-                fee = self.tx_fees.get(tx_hash)
+            fee = self.get_tx_fee(tx)
             if fee is not None:
                 size = tx.estimated_size()
                 fee_per_byte = fee / size
@@ -720,7 +713,7 @@ class Abstract_Wallet(AddressSynchronizer):
             # is_mine outputs should not be spent yet
             # to avoid cancelling our own dependent transactions
             txid = tx.txid()
-            if any([self.is_mine(o.address) and self.spent_outpoints[txid].get(output_idx)
+            if any([self.is_mine(o.address) and self.spent_outpoints.get((txid, output_idx))
                     for output_idx, o in enumerate(tx.outputs())]):
                 continue
             # all inputs should be is_mine
@@ -942,7 +935,7 @@ class Abstract_Wallet(AddressSynchronizer):
         else:
             return
         coins = self.get_addr_utxo(address)
-        item = coins.get(txid+':%d'%i)
+        item = coins.get((txid, i))
         if not item:
             return
         self.add_input_info(item)
@@ -963,7 +956,7 @@ class Abstract_Wallet(AddressSynchronizer):
             # segwit needs value to sign
             if txin.get('value') is None:
                 received, spent = self.get_addr_io(address)
-                item = received.get(txin['prevout_hash']+':%d'%txin['prevout_n'])
+                item = received.get((txin['prevout_hash'], txin['prevout_n']))
                 if item:
                     txin['value'] = item[1]
             self.add_input_sig_info(txin, address)
@@ -1076,9 +1069,8 @@ class Abstract_Wallet(AddressSynchronizer):
         local_height = self.get_local_height()
         received, sent = self.get_addr_io(address)
         l = []
-        for txo, x in received.items():
+        for (txid, n), x in received.items():
             h, v, is_cb = x
-            txid, n = txo.split(':')
             info = self.verified_tx.get(txid)
             if info:
                 conf = local_height - info.height
@@ -1312,10 +1304,10 @@ class Abstract_Wallet(AddressSynchronizer):
     def txin_value(self, txin):
         txid = txin['prevout_hash']
         prev_n = txin['prevout_n']
-        for address, d in self.txo.get(txid, {}).items():
-            for n, v, cb in d:
-                if n == prev_n:
-                    return v
+        txout = self.outpoint_to_txout.get((txid, prev_n))
+        if txout is not None:
+            address, v, cb = txout
+            return v
         # may occur if wallet is not synchronized
         return None
 
@@ -1337,9 +1329,9 @@ class Abstract_Wallet(AddressSynchronizer):
         input_value = 0
         total_price = 0
         for addr, d in self.txi.get(txid, {}).items():
-            for ser, v in d:
+            for (prevout_hash, prevout_n), v in d:
                 input_value += v
-                total_price += self.coin_price(ser.split(':')[0], price_func, ccy, v)
+                total_price += self.coin_price(prevout_hash, price_func, ccy, v)
         return total_price / (input_value/Decimal(COIN))
 
     def clear_coin_price_cache(self):
@@ -1505,12 +1497,14 @@ class Imported_Wallet(Simple_Wallet):
                         transactions_new.add(tx_hash)
             transactions_to_remove -= transactions_new
             self.history.pop(address, None)
+            self._transactions_modified = True
 
             for tx_hash in transactions_to_remove:
                 self.remove_transaction(tx_hash)
                 self.tx_fees.pop(tx_hash, None)
-                self.verified_tx.pop(tx_hash, None)
+                self._pop_verified_tx(tx_hash)
                 self.unverified_tx.pop(tx_hash, None)
+                self._tx_height_changed(tx_hash)
                 self.transactions.pop(tx_hash, None)
             self.save_verified_tx()
         self.save_transactions()
@@ -1521,6 +1515,9 @@ class Imported_Wallet(Simple_Wallet):
 
         pubkey = self.get_public_key(address)
         self.addresses.pop(address)
+        with self.lock, self.transaction_lock:
+            # the wallet domain changed
+            self._reset_wallet_balance()
         if pubkey:
             # delete key iff no other address uses it (e.g. p2pkh and p2wpkh for same key)
             for txin_type in bitcoin.WIF_SCRIPT_TYPES.keys():
@@ -1538,6 +1535,9 @@ class Imported_Wallet(Simple_Wallet):
 
         self.storage.write()
 
+    def is_mine(self, address):
+        return address in self.addresses
+
     def get_address_index(self, address):
         return self.get_public_key(address)
 
@@ -1754,6 +1754,9 @@ class Deterministic_Wallet(Abstract_Wallet):
                 return False
         return True
 
+    def is_mine(self, address):
+        return address in self._addr_to_addr_index
+
     def get_address_index(self, address):
         return self._addr_to_addr_index[address]
 